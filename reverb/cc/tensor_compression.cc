@@ -14,6 +14,7 @@
 
 #include "reverb/cc/tensor_compression.h"
 
+#include <algorithm>
 #include <cstdint>
 
 #include "reverb/cc/platform/logging.h"
@@ -39,14 +40,34 @@ tensorflow::Tensor DeltaEncode(const tensorflow::Tensor& tensor, bool encode) {
   TF_CHECK_OK(output_reinterpret.BitcastFrom(
       output, tensorflow::DataTypeToEnum<T>::v(), output.shape()));
 
-  auto src = tensor_reinterpret.flat_outer_dims<T>();
-  auto dst = output_reinterpret.flat_outer_dims<T>();
-  for (int j = 0; j < src.dimension(1); j++) {
-    dst(0, j) = src(0, j);
-  }
-  for (int i = 1; i < src.dimension(0); i++) {
-    for (int j = 0; j < src.dimension(1); j++) {
-      dst(i, j) = src(i, j) + (encode ? -src(i - 1, j) : dst(i - 1, j));
+  const int64_t num_steps = tensor.dim_size(0);
+  if (num_steps == 0) return output;
+  const int64_t step_size = tensor.NumElements() / num_steps;
+
+  const T* src = tensor_reinterpret.flat<T>().data();
+  T* dst = output_reinterpret.flat<T>().data();
+  std::copy(src, src + step_size, dst);
+
+  // The rows are processed as flat arrays and `encode` is checked outside of
+  // the loops so that the compiler is able to vectorize the inner loops. Since
+  // `T` is unsigned the arithmetic wraps around on overflow.
+  if (encode) {
+    for (int64_t i = 1; i < num_steps; i++) {
+      const T* current = src + i * step_size;
+      const T* previous = current - step_size;
+      T* out = dst + i * step_size;
+      for (int64_t j = 0; j < step_size; j++) {
+        out[j] = static_cast<T>(current[j] - previous[j]);
+      }
+    }
+  } else {
+    for (int64_t i = 1; i < num_steps; i++) {
+      const T* current = src + i * step_size;
+      const T* previous = dst + (i - 1) * step_size;
+      T* out = dst + i * step_size;
+      for (int64_t j = 0; j < step_size; j++) {
+        out[j] = static_cast<T>(current[j] + previous[j]);
+      }
     }
   }
   return output;
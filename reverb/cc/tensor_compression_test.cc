@@ -48,6 +48,33 @@ TEST(TensorCompressionTest, EncodeMatchesDecode) {
   EncodeMatchesDecodeT<bool>();
 }
 
+TEST(TensorCompressionTest, EncodeWrapsAroundOnOverflow) {
+  tensorflow::Tensor tensor(tensorflow::DT_UINT8,
+                            tensorflow::TensorShape({3, 2}));
+  auto values = tensor.flat<tensorflow::uint8>();
+  values(0) = 0;
+  values(1) = 255;
+  values(2) = 1;
+  values(3) = 0;
+  values(4) = 255;
+  values(5) = 2;
+
+  tensorflow::Tensor expected(tensorflow::DT_UINT8,
+                              tensorflow::TensorShape({3, 2}));
+  auto expected_values = expected.flat<tensorflow::uint8>();
+  expected_values(0) = 0;
+  expected_values(1) = 255;
+  expected_values(2) = 1;
+  expected_values(3) = 1;
+  expected_values(4) = 254;
+  expected_values(5) = 2;
+
+  tensorflow::Tensor encoded = DeltaEncode(tensor, true);
+  test::ExpectTensorEqual<tensorflow::uint8>(encoded, expected);
+  test::ExpectTensorEqual<tensorflow::uint8>(DeltaEncode(encoded, false),
+                                             tensor);
+}
+
 TEST(TensorCompressionTest, EncodeListMatchesDecode) {
   tensorflow::Tensor tensor(tensorflow::DT_INT32,
                             tensorflow::TensorShape({16, 37, 6}));
@@ -152,6 +152,11 @@ absl::Status Writer::CreateItem(const std::string& table, int num_timesteps,
     return absl::FailedPreconditionError(
         "Calling method CreateItem after Close has been called");
   }
+  if (num_timesteps < 1) {
+    return absl::InvalidArgumentError(absl::StrCat(
+        "`num_timesteps` must be a positive integer, got ", num_timesteps,
+        "."));
+  }
   if (num_timesteps > chunks_.size() * chunk_length_ + buffer_.size()) {
     return absl::InvalidArgumentError(
         "Argument `num_timesteps` is larger than number of buffered "
@@ -279,6 +284,17 @@ absl::Status Writer::Flush() {
     return Finish(/*retry_on_unavailable=*/true);
   }
   if (!ConfirmItems(0)) {
+    // The item confirmation worker stops when the stream fails. The status of
+    // the stream explains why (e.g the table doesn't exist) so it is returned
+    // rather than a generic error.
+    if (stream_) {
+      stream_->WritesDone();
+      auto confirmation_status = StopItemConfirmationWorker();
+      auto status = FromGrpcStatus(stream_->Finish());
+      stream_ = nullptr;
+      REVERB_RETURN_IF_ERROR(status);
+      REVERB_RETURN_IF_ERROR(confirmation_status);
+    }
     return absl::InternalError(
         "Error when confirming that all items written to table.");
   }
@@ -191,6 +191,23 @@ class FakeInsertStream
   internal::Queue<uint64_t>* response_ids_;
 };
 
+// Accepts all requests but never confirms any items, as if the server had
+// failed the stream with `status`.
+class RejectingInsertStream : public FakeInsertStream {
+ public:
+  RejectingInsertStream(std::vector<InsertStreamRequest>* requests,
+                        grpc::Status status)
+      : FakeInsertStream(requests, 10000, grpc::Status::OK),
+        status_(std::move(status)) {}
+
+  bool Read(InsertStreamResponse* response) override { return false; }
+
+  grpc::Status Finish() override { return status_; }
+
+ private:
+  grpc::Status status_;
+};
+
 class FakeStub : public /* grpc_gen:: */MockReverbServiceStub {
  public:
   explicit FakeStub(std::list<FakeInsertStream*> streams,
@@ -358,6 +375,19 @@ TEST(WriterTest, FailsIfMethodsCalledAfterClose) {
   EXPECT_FALSE(writer.CreateItem("dist", 1, 1.0).ok());
 }
 
+TEST(WriterTest, CreateItemFailsIfNumTimestepsLessThanOne) {
+  std::vector<InsertStreamRequest> requests;
+  Writer writer(MakeGoodStub(&requests), 2, 10);
+  REVERB_ASSERT_OK(writer.Append(MakeTimestep()));
+
+  for (int num_timesteps : {0, -1}) {
+    auto status = writer.CreateItem("dist", num_timesteps, 1.0);
+    EXPECT_EQ(status.code(), absl::StatusCode::kInvalidArgument);
+    EXPECT_THAT(std::string(status.message()),
+                ::testing::HasSubstr("must be a positive integer"));
+  }
+}
+
 TEST(WriterTest, RetriesOnTransientError) {
   std::vector<InsertStreamRequest> requests;
   // 1 fail, then all success.
@@ -910,6 +940,22 @@ TEST(WriterTest, FlushBlocksUntilAllItemsConfirmed) {
   notification.WaitForNotification();
 }
 
+TEST(WriterTest, FlushReturnsStreamErrorIfItemsNotConfirmed) {
+  std::vector<InsertStreamRequest> requests;
+  auto stub = std::make_shared<FakeStub>(
+      std::list<FakeInsertStream*>{new RejectingInsertStream(
+          &requests, ToGrpcStatus(absl::NotFoundError("Table not found.")))});
+  Writer writer(stub, 1, 1, false, nullptr, 25);
+
+  REVERB_ASSERT_OK(writer.Append(MakeTimestep()));
+  REVERB_ASSERT_OK(writer.CreateItem("dist", 1, 1.0));
+
+  auto status = writer.Flush();
+  EXPECT_EQ(status.code(), absl::StatusCode::kNotFound);
+  EXPECT_THAT(std::string(status.message()),
+              ::testing::HasSubstr("Table not found."));
+}
+
 TEST(WriterTest, BlocksWhenMaxInFlighItemsReached) {
   std::vector<InsertStreamRequest> requests;
   auto pair = MakeStubWithExplicitResponseQueue(&requests);
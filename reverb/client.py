@@ -74,9 +74,16 @@ trajectories then the `insert`-method should be used.
 
 """
 
-from typing import Any, Dict, Generator, List, Optional
+import functools
+import os
+import queue
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Sequence, Tuple
 
 from absl import logging
+import numpy as np
 from reverb import errors
 from reverb import pybind
 from reverb import replay_sample
@@ -84,13 +91,37 @@ from reverb import reverb_types
 import tree
 
 from reverb.cc import schema_pb2
-from tensorflow.python.saved_model import nested_structure_coder  # pylint: disable=g-direct-tensorflow-import
+
+# pylint: disable=g-direct-tensorflow-import
+from tensorflow.core.protobuf import struct_pb2
+from tensorflow.python.saved_model import nested_structure_coder
+# pylint: enable=g-direct-tensorflow-import
+
+# Names of the `TableInfo` fields which are copied as is from the proto. The
+# signature is excluded as it has to be decoded first.
+_TABLE_INFO_FIELDS = tuple(
+    descr.name
+    for descr in schema_pb2.TableInfo.DESCRIPTOR.fields
+    if descr.name != 'signature')
+
+# Upper bound on the number of idle writers kept open by each `Client` for
+# `insert`. Only exceeded when more threads insert concurrently through the same
+# client, in which case the surplus writers are closed after use.
+_MAX_POOLED_INSERT_WRITERS = 8
+
+# Idle writers kept open for `insert` are closed by the next `insert` call once
+# they haven't been used for this long.
+_INSERT_WRITER_IDLE_TIMEOUT_SECONDS = 10
 
 
 class Writer:
   """Writer is used for streaming data of arbitrary length.
 
   See Client.writer for documentation.
+
+  Writers which are garbage collected without `close` having been called are
+  closed automatically. Set the environment variable `REVERB_WARN_UNCLOSED` to
+  a non-empty value to log a warning when this happens.
   """
 
   def __init__(self, internal_writer: pybind.Writer):
@@ -98,6 +129,13 @@ class Writer:
     self._writer = internal_writer
     self._closed = False
 
+    # Closes the internal writer if this object is garbage collected before
+    # `close` is called. Unlike `__del__`, the finalizer is guaranteed to run
+    # (at the latest when the interpreter exits) and is not affected by the
+    # order in which modules are torn down.
+    self._finalizer = weakref.finalize(self, _close_abandoned_writer,
+                                       internal_writer)
+
   def __enter__(self) -> 'Writer':
     if self._closed:
       raise ValueError('Cannot reuse already closed Writer')
@@ -106,12 +144,6 @@ class Writer:
   def __exit__(self, *_):
     self.close()
 
-  def __del__(self):
-    if not self._closed:
-      logging.warning(
-          'Writer-object deleted without calling .close explicitly.')
-      self.close()
-
   def __repr__(self):
     return repr(self._writer) + ', closed: ' + str(self._closed)
 
@@ -147,12 +179,34 @@ class Writer:
 
     ```
 
+    NOTE: The data of read-only, C-contiguous numpy arrays is referenced rather
+    than copied until it has been chunked. The caller must therefore not modify
+    the memory backing such arrays (e.g through a writeable base array) before
+    the writer has been flushed or closed.
+
     Args:
       data: The (possibly nested) structure to make available for new
         items to reference.
     """
     self._writer.Append(tree.flatten(data))
 
+  def append_timesteps(self, timesteps: Sequence[Any]):
+    """Appends multiple timesteps to the internal buffer.
+
+    A call to `append_timesteps` is equivalent to calling `append` once for
+    each element of `timesteps` but all the timesteps are passed to the C++
+    layer in a single call. This reduces the per step overhead when appending
+    small timesteps at a high rate.
+
+    Unlike `append_sequence`, the timesteps are not batched along a leading
+    dimension so they don't need to be stacked before they are appended.
+
+    Args:
+      timesteps: Sequence of (possibly nested) structures to make available for
+        new items to reference.
+    """
+    self._writer.AppendTimesteps([tree.flatten(t) for t in timesteps])
+
   def append_sequence(self, sequence: Any):
     """Appends sequence of data to the internal buffer.
 
@@ -224,8 +278,6 @@ class Writer:
       StatusNotOk: If num_timesteps is > than the timesteps currently available
         in the buffer.
     """
-    if num_timesteps < 1:
-      raise ValueError('num_timesteps (%d) must be a positive integer')
     self._writer.CreateItem(table, num_timesteps, priority)
 
   def flush(self):
@@ -258,6 +310,7 @@ class Writer:
     if self._closed:
       raise ValueError('close() has already been called on Writer.')
     self._closed = True
+    self._finalizer.detach()
     self._writer.Close(retry_on_unavailable)
 
 
@@ -267,17 +320,42 @@ class Client:
   Note: This client should primarily be used when inserting data or prototyping
   at very small scale.
   Whenever possible, prefer to use TFClient (see ./tf_client.py).
+
+  Note: To avoid setting up a new stream for every call, `insert` keeps up to
+  8 streams to the server open between calls. Each open stream occupies a
+  thread on the server (and one in the client) and keeps the most recently
+  inserted chunk alive on the server. Streams which have been idle for more
+  than 10 seconds are closed by the next `insert` call. Use
+  `close_insert_writers` to close them right away, e.g when the client won't
+  be used for inserting again. They are also closed when the client is
+  garbage collected.
   """
 
   def __init__(self, server_address: str, client: pybind.Client = None):
     """Constructor of Client.
 
+    Clients connected to the same `server_address` share the underlying gRPC
+    channel for as long as at least one of them is alive.
+
     Args:
       server_address: Address to the Reverb ReverbService.
       client: Optional pre-existing Client. For internal use only.
     """
     self._server_address = server_address
-    self._client = client if client else pybind.Client(server_address)
+    self._client = client if client else _get_or_create_client(server_address)
+
+    # Writers used by `insert`. Each writer keeps its stream to the server
+    # open so consecutive calls don't have to set up a new stream.
+    # Each writer is paired with the time (see `time.monotonic`) when it was
+    # last used.
+    self._insert_writers: List[Tuple[pybind.Writer, float]] = []
+    self._insert_writers_lock = threading.Lock()
+
+    # Closes the pooled writers when this object is garbage collected. Closing
+    # them explicitly avoids the blocking close being run (while holding the
+    # GIL) by the destructor of the C++ writers.
+    weakref.finalize(self, _close_insert_writers, self._insert_writers,
+                     self._insert_writers_lock)
 
   def __reduce__(self):
     return self.__class__, (self._server_address,)
@@ -308,11 +386,53 @@ class Client:
     if not priorities:
       raise ValueError('priorities must contain at least one item')
 
-    with self.writer(max_sequence_length=1) as writer:
-      writer.append(data)
-      for table, priority in priorities.items():
-        writer.create_item(
-            table=table, num_timesteps=1, priority=priority)
+    writer = None
+    idle_writers = []
+    with self._insert_writers_lock:
+      # The pool is ordered by when the writers were last used so the writers
+      # which have been idle for too long are at the front.
+      idle_deadline = time.monotonic() - _INSERT_WRITER_IDLE_TIMEOUT_SECONDS
+      while self._insert_writers and self._insert_writers[0][1] < idle_deadline:
+        idle_writers.append(self._insert_writers.pop(0)[0])
+
+      if self._insert_writers:
+        writer, _ = self._insert_writers.pop()
+
+    for idle_writer in idle_writers:
+      idle_writer.Close(False)
+
+    if writer is None:
+      # `Insert` flushes the writer, which blocks until all the items have been
+      # confirmed by the server, so the items of all tables can be in flight
+      # at the same time.
+      writer = self._client.NewWriter(1, 1, False, 25)
+
+    try:
+      writer.Insert(tree.flatten(data), list(priorities.items()))
+    except Exception:
+      # The writer could have been left in an inconsistent state so it is
+      # closed rather than returned to the pool. Errors raised when closing it
+      # are ignored so the original error is raised.
+      try:
+        writer.Close(False)
+      except Exception:  # pylint: disable=broad-except
+        pass
+      raise
+
+    with self._insert_writers_lock:
+      if len(self._insert_writers) < _MAX_POOLED_INSERT_WRITERS:
+        self._insert_writers.append((writer, time.monotonic()))
+        return
+
+    writer.Close(False)
+
+  def close_insert_writers(self):
+    """Closes the streams kept open (between calls) by `insert`.
+
+    The client can still be used afterwards, in which case `insert` opens new
+    streams when required.
+    """
+    _close_insert_writers(self._insert_writers, self._insert_writers_lock)
 
   def writer(self,
              max_sequence_length: int,
@@ -392,7 +512,8 @@ class Client:
       self,
       table: str,
       num_samples=1,
-      validation_timeout_ms=3000
+      validation_timeout_ms=3000,
+      prefetch: int = 0,
   ) -> Generator[List[replay_sample.ReplaySample], None, None]:
     """Samples `num_samples` items from table `table` of the Server.
 
@@ -424,36 +545,85 @@ class Client:
         signatures (if any) for `table`.  These signatures are used to validate
         incoming samples.  Signatures are only pulled once and cached.  Default
         wait time is 3 seconds.
+      prefetch: (default to 0) The maximum number of samples to fetch ahead of
+        the caller. If > 0 then samples are fetched in a background thread so
+        that the fetching overlaps with the processing of previous samples.
 
-    Yields:
-      Lists of timesteps (lists of instances of `ReplaySample`).
+    Returns:
+      A generator of lists of timesteps (lists of instances of `ReplaySample`).
       If data was inserted into the table via `insert`, then each element
       of the generator is a length 1 list containing a `ReplaySample`.
       If data was inserted via a writer, then each element is a list whose
       length is the sampled trajectory's length.
+
+    Raises:
+      ValueError: If prefetch < 0.
     """
+    # Validated here rather than in the generator so that the error is raised
+    # by the call instead of the first `next`.
+    if prefetch < 0:
+      raise ValueError(f'prefetch ({prefetch}) must be a non-negative integer')
+    return self._sample(table, num_samples, validation_timeout_ms, prefetch)
+
+  def _sample(
+      self,
+      table: str,
+      num_samples: int,
+      validation_timeout_ms: int,
+      prefetch: int,
+  ) -> Generator[List[replay_sample.ReplaySample], None, None]:
     buffer_size = 1
     sampler = self._client.NewSampler(table, num_samples, buffer_size,
                                       validation_timeout_ms)
+    trajectories = _sample_trajectories(sampler, num_samples)
+
+    if prefetch:
+      yield from _prefetch(trajectories, prefetch, sampler.Close)
+    else:
+      yield from trajectories
+
+  def sample_batch(
+      self,
+      table: str,
+      batch_size: int,
+      validation_timeout_ms=3000) -> replay_sample.ReplaySample:
+    """Samples a batch of `batch_size` items from table `table`.
 
-    for _ in range(num_samples):
-      sequence = []
-      last = False
-
-      while not last:
-        step, last = sampler.GetNextTimestep()
-        key = int(step[0])
-        probability = float(step[1])
-        table_size = int(step[2])
-        priority = float(step[3])
-        data = step[4:]
-        sequence.append(
-            replay_sample.ReplaySample(
-                info=replay_sample.SampleInfo(key, probability, table_size,
-                                              priority),
-                data=data))
-
-      yield sequence
+    Unlike `sample`, which yields one list of `ReplaySample` (one per timestep)
+    for every item, the sampled items are stacked into numpy arrays by the C++
+    layer. This avoids creating Python objects for every timestep of every item.
+
+    NOTE: This method should NOT be used for real training. TFClient (see
+    tf_client.py) has far superior performance and should always be preferred.
+
+    Args:
+      table: Name of the priority table to sample from.
+      batch_size: The number of items to sample.
+      validation_timeout_ms: The number of milliesconds to wait to pull
+        signatures (if any) for `table`. See `sample` for more details.
+
+    Returns:
+      A `ReplaySample` where the fields of `info` are arrays of shape
+      [batch_size] and `data` is a list of arrays of shape
+      [batch_size, N, ...], where N is the length of the sampled items.
+
+    Raises:
+      ValueError: If batch_size < 1 or if the sampled items do not have the
+        same length.
+    """
+    if batch_size < 1:
+      raise ValueError(
+          f'batch_size ({batch_size}) must be a positive integer')
+
+    sampler = self._client.NewSampler(table, batch_size, batch_size,
+                                      validation_timeout_ms)
+    try:
+      batch = sampler.GetNextSamples(batch_size)
+    finally:
+      sampler.Close()
+
+    return replay_sample.ReplaySample(
+        info=replay_sample.SampleInfo(*batch[:4]), data=batch[4:])
 
   def mutate_priorities(self,
                         table: str,
@@ -479,6 +649,36 @@ class Client:
       deletes = []
     self._client.MutatePriorities(table, list(updates.items()), deletes)
 
+  def mutate_priorities_batch(self,
+                              table: str,
+                              keys: np.ndarray,
+                              priorities: np.ndarray,
+                              deletes: Optional[np.ndarray] = None):
+    """Updates and/or deletes existing items using arrays of keys.
+
+    Equivalent to `mutate_priorities` but the updates are provided as two
+    aligned 1D arrays instead of a mapping. The arrays are read directly by the
+    C++ layer so no Python objects have to be created for each update. This is
+    useful when updating the priorities of a whole sampled batch.
+
+    Args:
+      table: Name of the priority table to update.
+      keys: 1D array of unsigned integers with the keys of the priority items to
+        update. If a key cannot be found then it is ignored.
+      priorities: 1D array of floating point numbers with the new priority
+        values of `keys`.
+      deletes: 1D array of unsigned integers with the keys of the priority items
+        to delete. If a key cannot be found then it is ignored.
+
+    Raises:
+      ValueError: If any array isn't 1D, if the keys aren't unsigned integers,
+        if the priorities aren't floating point numbers or if `keys` and
+        `priorities` have different sizes.
+    """
+    if deletes is None:
+      deletes = np.zeros(0, np.uint64)
+    self._client.MutatePrioritiesArray(table, keys, priorities, deletes)
+
   def reset(self, table: str):
     """Clears all items of the table and resets its RateLimiter.
 
@@ -516,15 +716,12 @@ class Client:
     for proto_string in info_proto_strings:
       proto = schema_pb2.TableInfo.FromString(proto_string)
       if proto.HasField('signature'):
-        signature = nested_structure_coder.StructureCoder().decode_proto(
-            proto.signature)
+        signature = _decode_signature(proto.signature.SerializeToString())
       else:
         signature = None
-      info_dict = dict((descr.name, getattr(proto, descr.name))
-                       for descr in proto.DESCRIPTOR.fields)
+      info_dict = {name: getattr(proto, name) for name in _TABLE_INFO_FIELDS}
       info_dict['signature'] = signature
-      name = str(info_dict['name'])
-      table_info[name] = reverb_types.TableInfo(**info_dict)
+      table_info[proto.name] = reverb_types.TableInfo(**info_dict)
     return table_info
 
   def checkpoint(self) -> str:
@@ -534,3 +731,123 @@ class Client:
       Absolute path to the saved checkpoint.
     """
     return self._client.Checkpoint()
+
+
+def _close_abandoned_writer(writer: pybind.Writer):
+  if os.environ.get('REVERB_WARN_UNCLOSED'):
+    logging.warning('Writer-object deleted without calling .close explicitly.')
+  writer.Close(True)
+
+
+def _close_insert_writers(writers: List[Tuple[pybind.Writer, float]],
+                          lock: threading.Lock):
+  with lock:
+    writers_to_close = [writer for writer, _ in writers]
+    writers.clear()
+
+  for writer in writers_to_close:
+    writer.Close(False)
+
+
+@functools.lru_cache(maxsize=128)
+def _decode_cached_signature(serialized_signature: bytes) -> Any:
+  # Signatures don't change after a table has been created so the (slow)
+  # decoding only has to be done once when `server_info` is polled.
+  return nested_structure_coder.StructureCoder().decode_proto(
+      struct_pb2.StructuredValue.FromString(serialized_signature))
+
+
+def _decode_signature(serialized_signature: bytes) -> Any:
+  # The cached signature is shared between all calls so its containers are
+  # copied to prevent callers from modifying it. The leaves (specs) are
+  # immutable and can be shared.
+  return tree.map_structure(lambda x: x,
+                            _decode_cached_signature(serialized_signature))
+
+
+# Internal clients (and thus gRPC channels) shared between all `Client`
+# instances connected to the same server address. The entries are removed once
+# all `Client` instances using them have been deleted. gRPC channels can't be
+# used across a fork so the entries are keyed by the id of the process which
+# created them.
+_CLIENTS: 'weakref.WeakValueDictionary[Tuple[int, str], pybind.Client]' = (
+    weakref.WeakValueDictionary())
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_or_create_client(server_address: str) -> pybind.Client:
+  key = (os.getpid(), server_address)
+  with _CLIENTS_LOCK:
+    client = _CLIENTS.get(key)
+    if client is None:
+      client = pybind.Client(server_address)
+      _CLIENTS[key] = client
+    return client
+
+
+# Marks the end of the elements pushed to the queue by `_prefetch`.
+_END_OF_PREFETCH = object()
+
+
+def _sample_trajectories(
+    sampler: pybind.Sampler,
+    num_samples: int) -> Iterator[List[replay_sample.ReplaySample]]:
+  for _ in range(num_samples):
+    yield [
+        replay_sample.ReplaySample(
+            info=replay_sample.SampleInfo(*info), data=data)
+        for info, data in sampler.GetNextTimesteps()
+    ]
+
+
+def _prefetch(iterator: Iterator[Any], buffer_size: int,
+              cancel: Callable[[], None]) -> Iterator[Any]:
+  """Consumes `iterator` in a background thread.
+
+  Args:
+    iterator: Iterator to consume. Must not be used by any other thread.
+    buffer_size: Maximum number of elements to fetch ahead of the caller.
+    cancel: Called when the caller stops iterating to unblock the background
+      thread if it is waiting for `iterator`.
+
+  Yields:
+    The elements of `iterator`. Errors raised by `iterator` are reraised in the
+    calling thread.
+  """
+  buffer = queue.Queue(buffer_size)
+  stop = threading.Event()
+
+  def _put(element) -> bool:
+    while not stop.is_set():
+      try:
+        buffer.put(element, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _worker():
+    try:
+      for element in iterator:
+        if not _put((element, None)):
+          return
+    except Exception as e:  # pylint: disable=broad-except
+      _put((_END_OF_PREFETCH, e))
+    else:
+      _put((_END_OF_PREFETCH, None))
+
+  thread = threading.Thread(target=_worker, daemon=True)
+  thread.start()
+
+  try:
+    while True:
+      element, error = buffer.get()
+      if element is _END_OF_PREFETCH:
+        if error is not None:
+          raise error
+        return
+      yield element
+  finally:
+    stop.set()
+    cancel()
+    thread.join()
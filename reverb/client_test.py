@@ -17,7 +17,11 @@
 
 import collections
 import multiprocessing.dummy as multithreading
+import os
 import pickle
+import threading
+import time
+from unittest import mock
 
 from absl.testing import absltest
 import numpy as np
@@ -27,6 +31,7 @@ from reverb import item_selectors
 from reverb import rate_limiters
 from reverb import server
 import tensorflow.compat.v1 as tf
+from tensorflow.python.saved_model import nested_structure_coder  # pylint: disable=g-direct-tensorflow-import
 
 TABLE_NAME = 'table'
 
@@ -105,6 +110,78 @@ class ClientTest(absltest.TestCase):
       if key in expected_priorities:
         self.assertAlmostEqual(expected_priorities[key], priority)
 
+  def test_sample_with_prefetch(self):
+    for i in range(10):
+      self.client.insert(i, {TABLE_NAME: 1.0})
+
+    samples = list(self.client.sample(TABLE_NAME, 100, prefetch=5))
+    self.assertLen(samples, 100)
+    for sample in samples:
+      self.assertLen(sample, 1)
+      self.assertIn(sample[0].data[0], range(10))
+
+  def test_sample_with_prefetch_stops_when_generator_closed(self):
+    for i in range(3):
+      self.client.insert(i, {TABLE_NAME: 1.0})
+
+    threads_before = set(threading.enumerate())
+    generator = self.client.sample(TABLE_NAME, 100, prefetch=1)
+    next(generator)
+    prefetch_threads = set(threading.enumerate()) - threads_before
+    self.assertLen(prefetch_threads, 1)
+
+    # Closing the generator must stop the background thread without raising.
+    generator.close()
+    for thread in prefetch_threads:
+      self.assertFalse(thread.is_alive())
+    with self.assertRaises(StopIteration):
+      next(generator)
+
+  def test_sample_raises_if_prefetch_lt_0(self):
+    with self.assertRaises(ValueError):
+      self.client.sample(TABLE_NAME, 1, prefetch=-1)
+
+  def test_sample_batch(self):
+    for i in range(10):
+      self.client.insert(i, {TABLE_NAME: 1.0})
+
+    batch = self.client.sample_batch(TABLE_NAME, 16)
+    self.assertEqual(batch.info.key.shape, (16,))
+    self.assertEqual(batch.info.key.dtype, np.uint64)
+    self.assertEqual(batch.info.probability.shape, (16,))
+    np.testing.assert_array_equal(batch.info.table_size, [10] * 16)
+    np.testing.assert_array_equal(batch.info.priority, [1.0] * 16)
+    self.assertLen(batch.data, 1)
+    self.assertEqual(batch.data[0].shape, (16, 1))
+    self.assertTrue(np.all((batch.data[0] >= 0) & (batch.data[0] < 10)))
+
+  def test_sample_batch_raises_if_items_have_different_number_of_columns(self):
+    # Tables without signatures can hold items of any structure.
+    unsigned_server = server.Server(
+        tables=[
+            server.Table(
+                name=TABLE_NAME,
+                sampler=item_selectors.Fifo(),
+                remover=item_selectors.Fifo(),
+                max_size=10,
+                max_times_sampled=1,
+                rate_limiter=rate_limiters.MinSize(1)),
+        ],
+        port=None)
+    unsigned_client = client.Client(f'localhost:{unsigned_server.port}')
+
+    try:
+      unsigned_client.insert(1, {TABLE_NAME: 1.0})
+      unsigned_client.insert((1, 2), {TABLE_NAME: 1.0})
+      with self.assertRaises(ValueError):
+        unsigned_client.sample_batch(TABLE_NAME, 2)
+    finally:
+      unsigned_server.stop()
+
+  def test_sample_batch_raises_if_batch_size_lt_1(self):
+    with self.assertRaises(ValueError):
+      self.client.sample_batch(TABLE_NAME, 0)
+
   def test_insert_raises_if_priorities_empty(self):
     with self.assertRaises(ValueError):
       self.client.insert([1], {})
@@ -120,6 +197,39 @@ class ClientTest(absltest.TestCase):
     self.assertAlmostEqual(freqs[0], 0.9, delta=0.05)
     self.assertAlmostEqual(freqs[1], 0.1, delta=0.05)
 
+  def test_insert_works_after_failed_insert(self):
+    # The data doesn't match the signature of the table so the insert fails.
+    with self.assertRaises(ValueError):
+      self.client.insert(np.float32(1), {TABLE_NAME: 1.0})
+
+    for i in range(3):
+      self.client.insert(i, {TABLE_NAME: 1.0})
+
+    info = self.client.server_info()[TABLE_NAME]
+    self.assertEqual(info.current_size, 3)
+
+  def test_insert_closes_idle_writers(self):
+    self.client.close_insert_writers()
+    self.client.insert(1, {TABLE_NAME: 1.0})
+    self.assertLen(self.client._insert_writers, 1)
+    idle_writer, last_used = self.client._insert_writers[0]
+
+    # Once the writer has been idle for too long it is replaced.
+    now = last_used + client._INSERT_WRITER_IDLE_TIMEOUT_SECONDS + 1
+    with mock.patch.object(time, 'monotonic', return_value=now):
+      self.client.insert(2, {TABLE_NAME: 1.0})
+    self.assertLen(self.client._insert_writers, 1)
+    self.assertIsNot(self.client._insert_writers[0][0], idle_writer)
+
+  def test_close_insert_writers(self):
+    self.client.insert(1, {TABLE_NAME: 1.0})
+    self.client.close_insert_writers()
+    self.assertEmpty(self.client._insert_writers)
+
+    # New writers are created when the client is used again.
+    self.client.insert(2, {TABLE_NAME: 1.0})
+    self.assertEqual(self.client.server_info()[TABLE_NAME].current_size, 2)
+
   def test_writer_raises_if_max_sequence_length_lt_1(self):
     with self.assertRaises(ValueError):
       self.client.writer(0)
@@ -146,6 +256,23 @@ class ClientTest(absltest.TestCase):
     with self.assertRaises(ValueError):
       self.client.writer(1, max_in_flight_items=-1)
 
+  def test_writer_create_item_raises_if_num_timesteps_lt_1(self):
+    with self.client.writer(2) as writer:
+      writer.append([0])
+      for num_timesteps in [0, -1]:
+        with self.assertRaises(ValueError):
+          writer.create_item(TABLE_NAME, num_timesteps, 1.0)
+
+  def test_writer_is_closed_when_deleted(self):
+    writer = self.client.writer(1)
+    writer.append([0])
+    for _ in range(3):
+      writer.create_item(TABLE_NAME, 1, 1.0)
+    del writer
+
+    info = self.client.server_info()[TABLE_NAME]
+    self.assertEqual(info.current_size, 3)
+
   def test_writer_works_with_no_retries(self):
     # If the server responds correctly, the writer ignores the no retries arg.
     writer = self.client.writer(2)
@@ -169,6 +296,28 @@ class ClientTest(absltest.TestCase):
     for freq in freqs:
       self.assertAlmostEqual(freq, 0.25, delta=0.05)
 
+  def test_writer_append_timesteps(self):
+    with self.client.writer(3) as writer:
+      writer.append_timesteps([[0], [1], [2]])
+      writer.create_item(TABLE_NAME, 1, 1.0)
+      writer.create_item(TABLE_NAME, 2, 1.0)
+      writer.create_item(TABLE_NAME, 3, 1.0)
+
+    lengths = set(len(sample) for sample in self.client.sample(TABLE_NAME, 100))
+    self.assertEqual(lengths, {1, 2, 3})
+
+  def test_writer_append_read_only_arrays(self):
+    with self.client.writer(2) as writer:
+      for i in range(2):
+        data = np.array(i, dtype=np.int64)
+        data.setflags(write=False)
+        writer.append([data])
+      for _ in range(3):
+        writer.create_item(TABLE_NAME, 2, 1.0)
+
+    for sample in self.client.sample(TABLE_NAME, 3):
+      self.assertEqual([step.data[0] for step in sample], [0, 1])
+
   def test_mutate_priorities_update(self):
     self.client.insert([0], {TABLE_NAME: 1.0})
     self.client.insert([0], {TABLE_NAME: 1.0})
@@ -203,6 +352,54 @@ class ClientTest(absltest.TestCase):
     after = self._get_sample_frequency()
     self.assertLen(after, 3)
 
+  def test_mutate_priorities_batch(self):
+    self.client.insert([0], {TABLE_NAME: 1.0})
+    self.client.insert([0], {TABLE_NAME: 1.0})
+    self.client.insert([0], {TABLE_NAME: 1.0})
+    self.client.insert([0], {TABLE_NAME: 1.0})
+
+    keys = np.array(
+        list(set(sample[0].info.key
+                 for sample in self.client.sample(TABLE_NAME, 1000))),
+        dtype=np.uint64)
+    self.assertLen(keys, 4)
+
+    self.client.mutate_priorities_batch(
+        TABLE_NAME, keys[:1], np.array([0.5]), deletes=keys[1:2])
+
+    after = self._get_sample_frequency()
+    self.assertLen(after, 3)
+    self.assertAlmostEqual(after[0], 0.4, delta=0.05)
+    self.assertAlmostEqual(after[1], 0.4, delta=0.05)
+    self.assertAlmostEqual(after[2], 0.2, delta=0.05)
+
+  def test_mutate_priorities_batch_raises_if_sizes_differ(self):
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([1, 2], np.uint64), np.array([1.0]))
+
+  def test_mutate_priorities_batch_raises_if_arrays_not_1d(self):
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([[1, 2]], np.uint64), np.array([[1.0, 2.0]]))
+
+  def test_mutate_priorities_batch_raises_if_keys_not_unsigned_integers(self):
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([-1, 2], np.int64), np.array([1.0, 2.0]))
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([1.0, 2.0]), np.array([1.0, 2.0]))
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([1], np.uint64), np.array([1.0]),
+          deletes=np.array([-1], np.int64))
+
+  def test_mutate_priorities_batch_raises_if_priorities_not_floats(self):
+    with self.assertRaises(ValueError):
+      self.client.mutate_priorities_batch(
+          TABLE_NAME, np.array([1, 2], np.uint64), np.array([1, 2], np.int64))
+
   def test_reset(self):
     self.client.insert([0], {TABLE_NAME: 1.0})
     self.client.insert([0], {TABLE_NAME: 1.0})
@@ -238,6 +435,23 @@ class ClientTest(absltest.TestCase):
     self.assertTrue(info.remover_options.fifo)
     self.assertEqual(info.signature, tf.TensorSpec(dtype=tf.int64, shape=()))
 
+  def test_decoded_signature_can_be_modified_by_caller(self):
+    signature = {
+        'a': tf.TensorSpec(dtype=tf.int64, shape=()),
+        'b': [tf.TensorSpec(dtype=tf.float32, shape=(2,))],
+    }
+    serialized = nested_structure_coder.StructureCoder().encode_structure(
+        signature).SerializeToString()
+
+    first = client._decode_signature(serialized)
+    first['a'] = None
+    first['b'].append(None)
+
+    # The decoded specs are reused but not the structure containing them.
+    second = client._decode_signature(serialized)
+    self.assertEqual(second, signature)
+    self.assertIs(second['b'][0], first['b'][0])
+
   def test_server_info_timeout(self):
     # Setup a client that doesn't actually connect to anything.
     dummy_client = client.Client(f'localhost:{self.server.port + 1}')
@@ -246,6 +460,20 @@ class ClientTest(absltest.TestCase):
         msg='ServerInfo call did not complete within provided timeout of 1s'):
       dummy_client.server_info(timeout=1)
 
+  def test_clients_share_connection_to_same_server(self):
+    first = client.Client(f'localhost:{self.server.port}')
+    second = client.Client(f'localhost:{self.server.port}')
+    other = client.Client(f'localhost:{self.server.port + 1}')
+    self.assertIs(first._client, second._client)
+    self.assertIsNot(first._client, other._client)
+
+  def test_clients_do_not_share_connection_across_processes(self):
+    first = client.Client(f'localhost:{self.server.port}')
+    # Pretend to be a forked child process.
+    with mock.patch.object(os, 'getpid', return_value=os.getpid() + 1):
+      second = client.Client(f'localhost:{self.server.port}')
+    self.assertIsNot(first._client, second._client)
+
   def test_pickle(self):
     loaded_client = pickle.loads(pickle.dumps(self.client))
     self.assertEqual(loaded_client._server_address, self.client._server_address)
@@ -288,6 +516,20 @@ class ClientTest(absltest.TestCase):
     pool.close()
     pool.join()
 
+  def test_multithreaded_insert(self):
+    # Ensure that concurrent inserts don't share writers from the pool.
+    pool = multithreading.Pool(64)
+    def _insert(i):
+      self.client.insert([i], {TABLE_NAME: 1.0})
+
+    for _ in range(5):
+      pool.map(_insert, list(range(256)))
+
+    info = self.client.server_info()[TABLE_NAME]
+    self.assertEqual(info.current_size, 1000)
+    pool.close()
+    pool.join()
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -12,13 +12,17 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+#include <algorithm>
+#include <iterator>
 #include <memory>
 #include <string>
+#include <tuple>
 
 #include "numpy/arrayobject.h"
 #include "absl/container/inlined_vector.h"
 #include "absl/status/status.h"
 #include "absl/strings/str_cat.h"
+#include "absl/strings/string_view.h"
 #include "absl/time/time.h"
 #include "absl/types/optional.h"
 #include "pybind11/numpy.h"
@@ -36,12 +40,15 @@
 #include "reverb/cc/selectors/lifo.h"
 #include "reverb/cc/selectors/prioritized.h"
 #include "reverb/cc/selectors/uniform.h"
+#include "reverb/cc/support/tf_util.h"
+#include "reverb/cc/support/trajectory_util.h"
 #include "reverb/cc/table.h"
 #include "reverb/cc/table_extensions/interface.h"
 #include "reverb/cc/trajectory_writer.h"
 #include "reverb/cc/writer.h"
 #include "tensorflow/core/framework/tensor.h"
 #include "tensorflow/core/framework/tensor_shape.h"
+#include "tensorflow/core/framework/tensor_util.h"
 #include "tensorflow/core/framework/types.h"
 
 namespace {
@@ -344,6 +351,96 @@ tensorflow::Status NdArrayToTensor(PyObject *ndarray,
   return tensorflow::Status::OK();
 }
 
+// TensorBuffer which references the data of a numpy array instead of owning a
+// copy of it. A reference to the array is held until the buffer is destroyed.
+class NdArrayTensorBuffer : public tensorflow::TensorBuffer {
+ public:
+  explicit NdArrayTensorBuffer(PyArrayObject *array)
+      : tensorflow::TensorBuffer(PyArray_DATA(array)),
+        array_(array),
+        size_(PyArray_NBYTES(array)) {
+    Py_INCREF(array_);
+  }
+
+  ~NdArrayTensorBuffer() override {
+    // The buffer may be released by a thread which does not hold the GIL
+    // (e.g when the GIL is released while the data is being chunked).
+    pybind11::gil_scoped_acquire acquire;
+    Py_DECREF(array_);
+  }
+
+  size_t size() const override { return size_; }
+
+  tensorflow::TensorBuffer *root_buffer() override { return this; }
+
+  void FillAllocationDescription(
+      tensorflow::AllocationDescription *proto) const override {}
+
+  bool OwnsMemory() const override { return false; }
+
+ private:
+  PyArrayObject *array_;
+  const size_t size_;
+};
+
+// Like `NdArrayToTensor` but the data of read-only, C-contiguous and aligned
+// arrays is referenced rather than copied. The data of other arrays is copied
+// just like `NdArrayToTensor`.
+//
+// Read-only arrays are required as the tensor could otherwise be mutated by
+// the caller after it has been handed over to the C++ layer.
+tensorflow::Status NdArrayToBorrowedTensor(PyObject *ndarray,
+                                           tensorflow::Tensor *out_tensor) {
+  if (!PyArray_Check(ndarray)) {
+    return NdArrayToTensor(ndarray, out_tensor);
+  }
+
+  PyArrayObject *py_array = reinterpret_cast<PyArrayObject *>(ndarray);
+  if (PyArray_ISWRITEABLE(py_array) || !PyArray_IS_C_CONTIGUOUS(py_array) ||
+      reinterpret_cast<intptr_t>(PyArray_DATA(py_array)) %
+              std::max(1, EIGEN_MAX_ALIGN_BYTES) !=
+          0) {
+    return NdArrayToTensor(ndarray, out_tensor);
+  }
+
+  tensorflow::DataType dtype;
+  TF_RETURN_IF_ERROR(GetTensorDtypeFromPyArray(py_array, &dtype));
+  if (!tensorflow::DataTypeCanUseMemcpy(dtype)) {
+    return NdArrayToTensor(ndarray, out_tensor);
+  }
+
+  absl::InlinedVector<tensorflow::int64, 4> dims(PyArray_NDIM(py_array));
+  for (int i = 0; i < PyArray_NDIM(py_array); ++i) {
+    dims[i] = PyArray_SHAPE(py_array)[i];
+  }
+
+  auto *buffer = new NdArrayTensorBuffer(py_array);
+  *out_tensor =
+      tensorflow::Tensor(dtype, tensorflow::TensorShape(dims), buffer);
+  buffer->Unref();
+
+  return tensorflow::Status::OK();
+}
+
+// Tensor loaded using `NdArrayToBorrowedTensor`. The tensors can outlive the
+// binding call, e.g `Writer.Append` stores them in `Writer::buffer_`, so the
+// last reference may be released later by any thread (e.g the one which calls
+// `Flush`, `Close` or the destructor of the writer). This is safe because
+// `NdArrayTensorBuffer` acquires the GIL itself before releasing the array.
+struct BorrowedTensor {
+  tensorflow::Tensor tensor;
+};
+
+std::vector<tensorflow::Tensor> UnwrapBorrowedTensors(
+    std::vector<BorrowedTensor> borrowed) {
+  std::vector<tensorflow::Tensor> tensors;
+  tensors.reserve(borrowed.size());
+  for (auto &b : borrowed) {
+    tensors.push_back(std::move(b.tensor));
+  }
+  return tensors;
+}
+
 tensorflow::Status TensorToNdArray(const tensorflow::Tensor &tensor,
                                    PyObject **out_ndarray) {
   TF_RETURN_IF_ERROR(VerifyDtypeIsSupported(tensor.dtype()));
@@ -381,6 +478,119 @@ tensorflow::Status TensorToNdArray(const tensorflow::Tensor &tensor,
   return tensorflow::Status::OK();
 }
 
+// Stacks `tensors` into a single ndarray of shape [N, ...]. All tensors must
+// have the same dtype and shape. The data is copied directly from the tensors
+// into the ndarray, i.e without first being stacked into a tensor.
+tensorflow::Status StackTensorsToNdArray(
+    const std::vector<tensorflow::Tensor> &tensors, PyObject **out_ndarray) {
+  if (tensors.empty()) {
+    return tensorflow::errors::InvalidArgument("Cannot stack zero tensors.");
+  }
+
+  const tensorflow::Tensor &first = tensors.front();
+  for (const auto &tensor : tensors) {
+    if (tensor.dtype() != first.dtype() || tensor.shape() != first.shape()) {
+      return tensorflow::errors::InvalidArgument(
+          "Cannot stack tensors with different dtypes or shapes. Got ",
+          tensorflow::DataTypeString(first.dtype()),
+          first.shape().DebugString(), " and ",
+          tensorflow::DataTypeString(tensor.dtype()),
+          tensor.shape().DebugString(), ".");
+    }
+  }
+
+  // Strings can't be copied using memcpy so they are stacked into a tensor
+  // which is then converted like any other tensor.
+  if (!tensorflow::DataTypeCanUseMemcpy(first.dtype())) {
+    std::vector<tensorflow::Tensor> batched;
+    batched.reserve(tensors.size());
+    for (const auto &tensor : tensors) {
+      tensorflow::TensorShape shape = tensor.shape();
+      shape.InsertDim(0, 1);
+      batched.emplace_back();
+      if (!batched.back().CopyFrom(tensor, shape)) {
+        return tensorflow::errors::Internal(
+            "Unable to add batch dimension to tensor.");
+      }
+    }
+    tensorflow::Tensor stacked;
+    TF_RETURN_IF_ERROR(tensorflow::tensor::Concat(batched, &stacked));
+    return TensorToNdArray(stacked, out_ndarray);
+  }
+
+  TF_RETURN_IF_ERROR(VerifyDtypeIsSupported(first.dtype()));
+
+  PyArray_Descr *descr = nullptr;
+  TF_RETURN_IF_ERROR(GetPyDescrFromTensor(first, &descr));
+
+  absl::InlinedVector<npy_intp, 4> dims(first.dims() + 1);
+  dims[0] = tensors.size();
+  for (int i = 0; i < first.dims(); i++) {
+    dims[i + 1] = first.dim_size(i);
+  }
+
+  auto safe_out_ndarray =
+      make_safe(PyArray_Empty(dims.size(), dims.data(), descr, 0));
+  if (!safe_out_ndarray) {
+    return tensorflow::errors::Internal("Could not allocate ndarray");
+  }
+
+  char *data = static_cast<char *>(PyArray_DATA(
+      reinterpret_cast<PyArrayObject *>(safe_out_ndarray.get())));
+  for (const auto &tensor : tensors) {
+    auto tensor_data = tensor.tensor_data();
+    memcpy(data, tensor_data.data(), tensor_data.size());
+    data += tensor_data.size();
+  }
+
+  *out_ndarray = safe_out_ndarray.release();
+  return tensorflow::Status::OK();
+}
+
+// Stacks samples returned by `Sampler::GetNextSample` into a single batch.
+// The info tensors (key, probability, table_size and priority) hold the same
+// value for every timestep so only the first value of each sample is kept,
+// resulting in tensors of shape [B]. The data tensors are stacked into tensors
+// of shape [B, N, ...]. All samples must have the same length and shapes.
+tensorflow::Status StackSamples(
+    const std::vector<std::vector<tensorflow::Tensor>> &samples,
+    std::vector<tensorflow::Tensor> *batch) {
+  batch->clear();
+  if (samples.empty()) return tensorflow::Status::OK();
+
+  // Tables without a signature can hold items with different numbers of
+  // columns and these can't be stacked.
+  for (const auto &sample : samples) {
+    if (sample.size() != samples.front().size()) {
+      return tensorflow::errors::InvalidArgument(
+          "Unable to stack samples with different numbers of tensors: ",
+          samples.front().size(), " and ", sample.size(), ".");
+    }
+  }
+
+  for (int i = 0; i < samples.front().size(); i++) {
+    std::vector<tensorflow::Tensor> column;
+    column.reserve(samples.size());
+    for (const auto &sample : samples) {
+      if (i < 4) {
+        column.push_back(sample[i].Slice(0, 1));
+      } else {
+        tensorflow::TensorShape shape = sample[i].shape();
+        shape.InsertDim(0, 1);
+        column.emplace_back();
+        if (!column.back().CopyFrom(sample[i], shape)) {
+          return tensorflow::errors::Internal(
+              "Unable to add batch dimension to sampled tensor.");
+        }
+      }
+    }
+    batch->emplace_back();
+    TF_RETURN_IF_ERROR(tensorflow::tensor::Concat(column, &batch->back()));
+  }
+
+  return tensorflow::Status::OK();
+}
+
 // This wrapper exists for the sole purpose of allowing the weak_ptr to be
 // handled in Python. Pybind supports shared_ptr and unique_ptr out of the box
 // and although it is possible to implement our own `SmartPointer, using a
@@ -404,6 +614,69 @@ class WeakCellRef {
   std::weak_ptr<::deepmind::reverb::CellRef> ref_;
 };
 
+// Wraps the references returned by `TrajectoryWriter::Append` so they can be
+// returned to Python.
+std::vector<absl::optional<std::shared_ptr<WeakCellRef>>> WrapCellRefs(
+    std::vector<absl::optional<std::weak_ptr<::deepmind::reverb::CellRef>>>
+        refs) {
+  std::vector<absl::optional<std::shared_ptr<WeakCellRef>>> weak_refs(
+      refs.size());
+  for (int i = 0; i < refs.size(); i++) {
+    if (refs[i].has_value()) {
+      weak_refs[i] = std::make_shared<WeakCellRef>(std::move(refs[i].value()));
+    } else {
+      weak_refs[i] = absl::nullopt;
+    }
+  }
+  return weak_refs;
+}
+
+// Gets the data referenced by `refs`. Finalized chunks are only decompressed
+// once even if they are referenced by multiple (consecutive) references.
+absl::Status GetWeakCellRefsData(
+    const std::vector<std::shared_ptr<WeakCellRef>> &refs,
+    std::vector<tensorflow::Tensor> *out) {
+  out->clear();
+  out->reserve(refs.size());
+
+  bool has_chunk_column = false;
+  uint64_t chunk_key = 0;
+  tensorflow::Tensor chunk_column;
+  for (const auto &weak_ref : refs) {
+    // Columns contain None for the steps where the field was not present.
+    if (!weak_ref) {
+      return absl::InvalidArgumentError(
+          "Cannot access data of missing (None) WeakCellRef");
+    }
+
+    auto ref = weak_ref->ref().lock();
+    if (!ref) {
+      return absl::FailedPreconditionError(
+          "Cannot access data from expired WeakCellRef");
+    }
+
+    // The data of references to chunks which have not yet been finalized is
+    // still held by the chunker.
+    if (!ref->IsReady()) {
+      out->emplace_back();
+      auto status = ref->GetData(&out->back());
+      if (!status.ok()) return status;
+      continue;
+    }
+
+    if (!has_chunk_column || ref->chunk_key() != chunk_key) {
+      auto status = ::deepmind::reverb::internal::UnpackChunkColumn(
+          *ref->GetChunk(), 0, &chunk_column);
+      if (!status.ok()) return status;
+      has_chunk_column = true;
+      chunk_key = ref->chunk_key();
+    }
+    out->push_back(chunk_column.SubSlice(ref->offset()));
+  }
+
+  return absl::OkStatus();
+}
+
 }  // namespace
 
 namespace pybind11 {
@@ -463,6 +736,28 @@ struct type_caster<tensorflow::Tensor> {
   }
 };
 
+template <>
+struct type_caster<BorrowedTensor> {
+ public:
+  PYBIND11_TYPE_CASTER(BorrowedTensor, _("tensorflow::Tensor"));
+
+  bool load(handle handle, bool) {
+    tensorflow::Status status =
+        NdArrayToBorrowedTensor(handle.ptr(), &value.tensor);
+
+    if (!status.ok()) {
+      std::string message = status.ToString();
+      REVERB_LOG(REVERB_ERROR)
+          << "Tensor can't be extracted from the source represented as "
+             "ndarray: "
+          << message;
+      PyErr_Clear();
+      return false;
+    }
+    return true;
+  }
+};
+
 // Raise an exception if a given status is not OK, otherwise return None.
 template <>
 struct type_caster<absl::Status> {
@@ -483,6 +778,26 @@ namespace {
 
 namespace py = pybind11;
 
+// Checks that `array` is a 1D array of floating point numbers if `floating` is
+// true and of unsigned integers otherwise. `name` is used in the error message.
+absl::Status Validate1DArray(const py::array &array, absl::string_view name,
+                             bool floating) {
+  auto *py_array = reinterpret_cast<PyArrayObject *>(array.ptr());
+  if (PyArray_NDIM(py_array) != 1) {
+    return absl::InvalidArgumentError(
+        absl::StrCat(name, " must be a 1D array but got an array with ",
+                     PyArray_NDIM(py_array), " dimensions."));
+  }
+  if (floating ? !PyArray_ISFLOAT(py_array) : !PyArray_ISUNSIGNED(py_array)) {
+    return absl::InvalidArgumentError(absl::StrCat(
+        name, " must be an array of ",
+        floating ? "floating point numbers" : "unsigned integers",
+        " but got an array of type ", NumpyTypeName(PyArray_TYPE(py_array)),
+        "."));
+  }
+  return absl::OkStatus();
+}
+
 PYBIND11_MODULE(libpybind, m) {
   // Initialization code to use numpy types in the type casters.
   ImportNumpy();
@@ -563,7 +878,45 @@ PYBIND11_MODULE(libpybind, m) {
            py::call_guard<py::gil_scoped_release>());
 
   py::class_<Writer>(m, "Writer")
-      .def("Append", &Writer::Append, py::call_guard<py::gil_scoped_release>())
+      .def(
+          "Append",
+          [](Writer *writer, std::vector<BorrowedTensor> data) {
+            return writer->Append(UnwrapBorrowedTensors(std::move(data)));
+          },
+          py::call_guard<py::gil_scoped_release>())
+      .def(
+          "AppendTimesteps",
+          [](Writer *writer,
+             std::vector<std::vector<BorrowedTensor>> timesteps) {
+            for (auto &timestep : timesteps) {
+              auto status =
+                  writer->Append(UnwrapBorrowedTensors(std::move(timestep)));
+              if (!status.ok()) return status;
+            }
+            return absl::OkStatus();
+          },
+          py::call_guard<py::gil_scoped_release>())
+      .def(
+          "Insert",
+          [](Writer *writer, std::vector<BorrowedTensor> data,
+             const std::vector<std::pair<std::string, double>> &priorities) {
+            // Appends a single timestep, creates one item per table which
+            // references it and blocks until the items have been confirmed by
+            // the server. The stream is kept open so the writer can be reused
+            // for the next call.
+            auto status =
+                writer->Append(UnwrapBorrowedTensors(std::move(data)));
+            if (!status.ok()) return status;
+
+            for (const auto &table_and_priority : priorities) {
+              status = writer->CreateItem(table_and_priority.first,
+                                          /*num_timesteps=*/1,
+                                          table_and_priority.second);
+              if (!status.ok()) return status;
+            }
+            return writer->Flush();
+          },
+          py::call_guard<py::gil_scoped_release>())
       .def("AppendSequence", &Writer::AppendSequence,
            py::call_guard<py::gil_scoped_release>())
       .def("CreateItem", &Writer::CreateItem,
@@ -595,6 +948,49 @@ PYBIND11_MODULE(libpybind, m) {
              MaybeRaiseFromStatus(status);
              return std::make_pair(std::move(sample), end_of_sequence);
            })
+      // Fetches all the timesteps of the next sample using `GetNextTimestep`.
+      // Unlike `Sampler::GetNextTrajectory`, the timesteps are returned one by
+      // one rather than as a single flat trajectory.
+      .def("GetNextTimesteps",
+           [](Sampler *sampler) {
+             std::vector<std::vector<tensorflow::Tensor>> timesteps;
+             absl::Status status;
+
+             // Release the GIL while the entire trajectory is being fetched.
+             // The GIL must be reacquired before `MaybeRaiseFromStatus` is
+             // called (see `GetNextTimestep`).
+             {
+               py::gil_scoped_release g;
+               bool end_of_sequence = false;
+               while (status.ok() && !end_of_sequence) {
+                 timesteps.emplace_back();
+                 status = sampler->GetNextTimestep(&timesteps.back(),
+                                                   &end_of_sequence);
+               }
+             }
+
+             MaybeRaiseFromStatus(status);
+
+             // The info tensors are unpacked into (key, probability,
+             // table_size, priority) so they are returned as Python scalars
+             // rather than as numpy arrays.
+             using Info = std::tuple<tensorflow::uint64, double,
+                                     tensorflow::int64, double>;
+             std::vector<std::pair<Info, std::vector<tensorflow::Tensor>>>
+                 trajectory;
+             trajectory.reserve(timesteps.size());
+             for (auto &step : timesteps) {
+               trajectory.emplace_back(
+                   Info(step[0].scalar<tensorflow::uint64>()(),
+                        step[1].scalar<double>()(),
+                        step[2].scalar<tensorflow::int64>()(),
+                        step[3].scalar<double>()()),
+                   std::vector<tensorflow::Tensor>(
+                       std::make_move_iterator(step.begin() + 4),
+                       std::make_move_iterator(step.end())));
+             }
+             return trajectory;
+           })
       .def("GetNextSample",
            [](Sampler *sampler) {
              absl::Status status;
@@ -612,6 +1008,30 @@ PYBIND11_MODULE(libpybind, m) {
              MaybeRaiseFromStatus(status);
              return sample;
            })
+      .def("GetNextSamples",
+           [](Sampler *sampler, int num_samples) {
+             std::vector<std::vector<tensorflow::Tensor>> samples(num_samples);
+             std::vector<tensorflow::Tensor> batch;
+             absl::Status status;
+
+             // Release the GIL only when waiting for the call to complete. If
+             // the GIL is not held when `MaybeRaiseFromStatus` is called it can
+             // result in segfaults as the Python exception is populated with
+             // details from the status.
+             {
+               py::gil_scoped_release g;
+               for (auto &sample : samples) {
+                 status = sampler->GetNextSample(&sample);
+                 if (!status.ok()) break;
+               }
+               if (status.ok()) {
+                 status = FromTensorflowStatus(StackSamples(samples, &batch));
+               }
+             }
+
+             MaybeRaiseFromStatus(status);
+             return batch;
+           })
       .def("Close", &Sampler::Close, py::call_guard<py::gil_scoped_release>());
 
   py::class_<Client>(m, "Client")
@@ -667,6 +1087,53 @@ PYBIND11_MODULE(libpybind, m) {
             return client->MutatePriorities(table, update_protos, deletes);
           },
           py::call_guard<py::gil_scoped_release>())
+      .def(
+          "MutatePrioritiesArray",
+          [](Client *client, const std::string &table, py::array keys,
+             py::array priorities, py::array deletes) {
+            // The arrays are validated before they are cast so that e.g
+            // negative or floating point keys are rejected rather than
+            // silently converted.
+            MaybeRaiseFromStatus(Validate1DArray(keys, "keys", false));
+            MaybeRaiseFromStatus(
+                Validate1DArray(priorities, "priorities", true));
+            MaybeRaiseFromStatus(Validate1DArray(deletes, "deletes", false));
+            if (keys.size() != priorities.size()) {
+              MaybeRaiseFromStatus(absl::InvalidArgumentError(absl::StrCat(
+                  "Size of keys (", keys.size(),
+                  ") did not match size of priorities (", priorities.size(),
+                  ").")));
+            }
+
+            constexpr int kFlags = py::array::c_style | py::array::forcecast;
+            using KeysArray = py::array_t<uint64_t, kFlags>;
+            using PrioritiesArray = py::array_t<double, kFlags>;
+            auto keys_array = KeysArray::ensure(keys);
+            auto priorities_array = PrioritiesArray::ensure(priorities);
+            auto deletes_array = KeysArray::ensure(deletes);
+            if (!keys_array || !priorities_array || !deletes_array) {
+              throw py::error_already_set();
+            }
+
+            std::vector<KeyWithPriority> update_protos(keys_array.size());
+            const uint64_t *keys_data = keys_array.data();
+            const double *priorities_data = priorities_array.data();
+            for (py::ssize_t i = 0; i < keys_array.size(); i++) {
+              update_protos[i].set_key(keys_data[i]);
+              update_protos[i].set_priority(priorities_data[i]);
+            }
+            std::vector<uint64_t> delete_keys(
+                deletes_array.data(),
+                deletes_array.data() + deletes_array.size());
+
+            absl::Status status;
+            {
+              py::gil_scoped_release g;
+              status = client->MutatePriorities(table, update_protos,
+                                                delete_keys);
+            }
+            MaybeRaiseFromStatus(status);
+          })
       .def("Reset", &Client::Reset, py::call_guard<py::gil_scoped_release>())
       .def("ServerInfo",
            [](Client *client, int timeout_sec) {
@@ -754,13 +1221,29 @@ PYBIND11_MODULE(libpybind, m) {
         absl::Status status;
         {
           py::gil_scoped_release g;
-          auto status = sp->GetData(&tensor);
+          status = sp->GetData(&tensor);
         }
         MaybeRaiseFromStatus(status);
 
         return tensor;
       });
 
+  m.def("stack_weak_cell_refs",
+        [](const std::vector<std::shared_ptr<WeakCellRef>> &refs) {
+          std::vector<tensorflow::Tensor> tensors;
+          absl::Status status;
+          {
+            py::gil_scoped_release g;
+            status = GetWeakCellRefsData(refs, &tensors);
+          }
+          MaybeRaiseFromStatus(status);
+
+          PyObject *ndarray = nullptr;
+          MaybeRaiseFromStatus(
+              FromTensorflowStatus(StackTensorsToNdArray(tensors, &ndarray)));
+          return py::reinterpret_steal<py::object>(ndarray);
+        });
+
   py::class_<TrajectoryWriter, std::shared_ptr<TrajectoryWriter>>(
       m, "TrajectoryWriter")
       .def(
@@ -768,20 +1251,40 @@ PYBIND11_MODULE(libpybind, m) {
           [](TrajectoryWriter *writer,
              std::vector<absl::optional<tensorflow::Tensor>> data) {
             std::vector<absl::optional<std::weak_ptr<CellRef>>> refs;
-            MaybeRaiseFromStatus(writer->Append(std::move(data), &refs));
-
-            std::vector<absl::optional<std::shared_ptr<WeakCellRef>>> weak_refs(
-                refs.size());
-            for (int i = 0; i < refs.size(); i++) {
-              if (refs[i].has_value()) {
-                weak_refs[i] =
-                    std::make_shared<WeakCellRef>(std::move(refs[i].value()));
-              } else {
-                weak_refs[i] = absl::nullopt;
+            absl::Status status;
+            {
+              py::gil_scoped_release g;
+              status = writer->Append(std::move(data), &refs);
+            }
+            MaybeRaiseFromStatus(status);
+            return WrapCellRefs(std::move(refs));
+          })
+      .def(
+          "AppendBatch",
+          [](TrajectoryWriter *writer,
+             std::vector<std::vector<absl::optional<tensorflow::Tensor>>> batch,
+             py::list out) {
+            // The references of the steps are added to `out` rather than
+            // returned so the steps appended before a failing step are
+            // available to the caller even when the error is raised.
+            using WeakCellRefs =
+                std::vector<absl::optional<std::shared_ptr<WeakCellRef>>>;
+            std::vector<WeakCellRefs> weak_refs;
+            weak_refs.reserve(batch.size());
+            absl::Status status;
+            {
+              py::gil_scoped_release g;
+              for (auto &data : batch) {
+                std::vector<absl::optional<std::weak_ptr<CellRef>>> refs;
+                status = writer->Append(std::move(data), &refs);
+                if (!status.ok()) break;
+                weak_refs.push_back(WrapCellRefs(std::move(refs)));
               }
             }
-
-            return weak_refs;
+            for (auto &refs : weak_refs) {
+              out.append(py::cast(std::move(refs)));
+            }
+            MaybeRaiseFromStatus(status);
           })
       .def(
           "CreateItem",
@@ -19,9 +19,10 @@ changes may occur without notice. Please talk to cassirer@ if you wish to alpha
 test these features.
 """
 
+import collections
 import datetime
 
-from typing import Any, List, Iterator, Mapping, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, List, Iterator, Mapping, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from reverb import client as client_lib
@@ -65,6 +66,7 @@ class TrajectoryWriter:
     """
     self._writer = client._client.NewTrajectoryWriter(max_chunk_length,
                                                       num_keep_alive_refs)
+    self._num_keep_alive_refs = num_keep_alive_refs
 
     # The union of the structures of all data passed to `append`. The structure
     # grows everytime the provided data contains one or more fields which were
@@ -79,18 +81,31 @@ class TrajectoryWriter:
     # `_flatten` and `_unflatten` for more details.
     self._column_history: List[_ColumnHistory] = []
 
+    # Bound `append` methods of `_column_history`, cached to avoid the attribute
+    # lookup for every column of every step.
+    self._column_appenders: List[Callable[[Any], None]] = []
+
     # Mapping from structured paths (i.e as received from
     # `tree.flatten_with_path`) to position in `_column_history`. This is used
     # in `_flatten`.
     self._path_to_column_index: Mapping[str, int] = {}
 
-    # The inverse of `_path_to_column_index`. That is the mapping describes the
-    # swaps required to go from the order of `column_history` (and the C++
-    # writer) to the order of a sequence which can be unflattened into
-    # `_structure`. This is used in `_unflatten`.
-    self._column_index_to_flat_structure_index: Mapping[int, int] = {}
+    # Permutations between the order of `_column_history` (and the C++ writer)
+    # and the order of `tree.flatten(_structure)`. The first maps each column
+    # index to the index of the leaf within the flattened structure and is used
+    # in `_flatten`. The second is its inverse and is used in `_unflatten`.
+    self._column_index_to_flat_structure_index: List[int] = []
+    self._flat_structure_index_to_column_index: List[int] = []
+
+    # True if the permutations above are the identity, i.e. no field was added
+    # before an existing one, in which case no reordering is required.
+    self._reorder_is_identity = True
     self._path_to_column_config = {}
 
+    # `_column_history` structured like `_structure`. The columns are updated in
+    # place so this only has to be rebuilt when the structure changes.
+    self._history = None
+
   def __enter__(self) -> 'TrajectoryWriter':
     return self
 
@@ -135,18 +150,18 @@ class TrajectoryWriter:
 
     ```
 
+    The same (cached) structure is returned until the structure of the appended
+    data changes, and the columns are updated in place as data is appended. The
+    returned structure must therefore be treated as read-only.
+
     Raises:
       RuntimeError: If `append` hasn't been called at least once before.
     """
-    if self._structure is None:
+    if self._history is None:
       raise RuntimeError(
           'history cannot be accessed before `append` is called at least once.')
 
-    reordered_flat_history = [
-        self._column_history[self._column_index_to_flat_structure_index[i]]
-        for i in range(len(self._column_history))
-    ]
-    return tree.unflatten_as(self._structure, reordered_flat_history)
+    return self._history
 
   def configure(self, path: Tuple[Union[int, str], ...], max_chunk_length: int,
                 num_keep_alive_refs: int):
@@ -160,8 +175,11 @@ class TrajectoryWriter:
         __init__ for more details.
     """
     if path in self._path_to_column_index:
-      self._writer.ConfigureChunker(self._path_to_column_index[path],
-                                    max_chunk_length, num_keep_alive_refs)
+      column_index = self._path_to_column_index[path]
+      self._writer.ConfigureChunker(column_index, max_chunk_length,
+                                    num_keep_alive_refs)
+      self._column_history[column_index].set_num_keep_alive_refs(
+          num_keep_alive_refs)
     else:
       self._path_to_column_config[path] = (max_chunk_length,
                                            num_keep_alive_refs)
@@ -188,33 +206,9 @@ class TrajectoryWriter:
     Returns:
       References to the data structured just like provided `data`.
     """
-    # Unless it is the first step, check that the structure is the same.
-    if self._structure is None:
-      self._update_structure(tree.map_structure(lambda _: None, data))
-
-    try:
-      tree.assert_same_structure(data, self._structure, True)
-      expanded_data = data
-    except ValueError:
-      try:
-        # If `data` is a subset of the full spec then we can simply fill in the
-        # gaps with None.
-        expanded_data = _tree_merge_into(source=data, target=self._structure)
-      except ValueError:
-        # `data` contains fields which haven't been observed before so we need
-        # expand the spec using the union of the history and `data`.
-        self._update_structure(
-            _tree_union(self._structure,
-                        tree.map_structure(lambda x: None, data)))
-
-        # Now that the structure has been updated to include all the fields in
-        # `data` we are able to expand `data` to the full structure. Note that
-        # if `data` is a superset of the previous history structure then this
-        # "expansion" is just a noop.
-        expanded_data = _tree_merge_into(data, self._structure)
-
-    # Use our custom mapping to flatten the expanded structure into columns.
-    flat_column_data = self._flatten(expanded_data)
+    # Use our custom mapping to flatten `data` into columns. If `data` contains
+    # fields which haven't been seen before then the structure is updated first.
+    flat_column_data, data_paths = self._flatten_step(data)
 
     # Flatten the data and pass it to the C++ writer for column wise append. In
     # all columns where data is provided (i.e not None) will return a reference
@@ -226,18 +220,70 @@ class TrajectoryWriter:
     # Append references to respective columns. Note that we use the expanded
     # structure in order to populate the columns missing from the data with
     # None.
-    for column, data_reference in zip(self._column_history,
+    for append, data_reference in zip(self._column_appenders,
                                       flat_column_data_references):
-      column.append(data_reference)
+      append(data_reference)
 
-    # Unpack the column data into the expanded structure.
-    expanded_structured_data_references = self._unflatten(
-        flat_column_data_references)
+    return self._structure_references(data, data_paths,
+                                      flat_column_data_references)
 
-    # Return the referenced structured in the same way as `data`. If only a
-    # subset of the fields were present in the input data then only these fields
-    # will exist in the output.
-    return _tree_filter(expanded_structured_data_references, data)
+  def append_batch(self, data: Sequence[Any]) -> List[Any]:
+    """Columnwise append of multiple steps using a single call to C++ writer.
+
+    Equivalent to calling `append` for each element of `data` but the flat data
+    of all the steps is passed to the C++ writer at once. If a step fails to be
+    appended then the steps before it remain in the history, just as if
+    `append` had been called for each step, before the error is raised.
+
+    Args:
+      data: Sequence of (possibly nested) structures, one for each step, to make
+        available for new items to reference.
+
+    Returns:
+      List with references to the data of each step, structured just like the
+      respective element of `data`.
+    """
+    steps = []
+    for step_data in data:
+      flat_column_data, data_paths = self._flatten_step(step_data)
+      steps.append((step_data, data_paths, self._structure, flat_column_data))
+
+    # Steps flattened before the structure evolved are missing the new columns.
+    # These are always added to the back so they can simply be padded with None.
+    num_columns = len(self._column_history)
+    flat_batch_data = [
+        flat_column_data + [None] * (num_columns - len(flat_column_data))
+        for _, _, _, flat_column_data in steps
+    ]
+
+    # If a step fails to be appended then the steps before it have still been
+    # appended by the C++ writer. Their references are added to
+    # `flat_batch_data_references` before the error is raised so the history
+    # stays in sync with the C++ writer.
+    flat_batch_data_references = []
+    try:
+      self._writer.AppendBatch(flat_batch_data, flat_batch_data_references)
+    finally:
+      for flat_column_data_references in flat_batch_data_references:
+        for append, data_reference in zip(self._column_appenders,
+                                          flat_column_data_references):
+          append(data_reference)
+
+    batch_references = []
+    for step, flat_column_data_references in zip(steps,
+                                                 flat_batch_data_references):
+      step_data, data_paths, structure, _ = step
+
+      # If the structure evolved after the step then the step no longer
+      # contains all the fields so the references must be looked up by path.
+      if data_paths is None and structure is not self._structure:
+        data_paths = [path for path, _ in tree.flatten_with_path(step_data)]
+
+      batch_references.append(
+          self._structure_references(step_data, data_paths,
+                                     flat_column_data_references))
+
+    return batch_references
 
   def create_item(self, table: str, priority: float, trajectory: Any):
     """Enqueue insertion of an item into `table` referencing `trajectory`.
@@ -269,10 +315,12 @@ class TrajectoryWriter:
 
     # Pass the flatten trajectory to the C++ writer where it will be validated
     # and if successful then the item is created and enqued for the background
-    # worker to send to the server.
-    self._writer.CreateItem(table, priority,
-                            [list(column) for column in flat_trajectory],
-                            [column.is_squeezed for column in flat_trajectory])
+    # worker to send to the server. The (immutable) tuples of references are
+    # passed as is since pybind accepts any sequence.
+    self._writer.CreateItem(
+        table, priority,
+        [column._data_references for column in flat_trajectory],  # pylint: disable=protected-access
+        [column.is_squeezed for column in flat_trajectory])
 
   def flush(self,
             block_until_num_items: int = 0,
@@ -352,18 +400,88 @@ class TrajectoryWriter:
   def close(self):
     self._writer.Close()
 
-  def _flatten(self, data):
-    flat_data = [None] * len(self._path_to_column_index)
-    for path, value in tree.flatten_with_path(data):
-      flat_data[self._path_to_column_index[path]] = value
-    return flat_data
+  def _flatten_step(self, data):
+    """Flattens `data` into columns, evolving the structure if required.
 
-  def _unflatten(self, flat_data):
-    reordered_flat_data = [
-        flat_data[self._column_index_to_flat_structure_index[i]]
-        for i in range(len(flat_data))
-    ]
-    return tree.unflatten_as(self._structure, reordered_flat_data)
+    Args:
+      data: The (possibly nested) structure passed to `append`.
+
+    Returns:
+      A tuple of the flat column data and the paths of the leaves in `data`. If
+      `data` has the same structure as the history then the paths are not
+      required (to unpack the references) and None is returned instead.
+
+    Raises:
+      ValueError: If `data` is not compatible with the history structure.
+    """
+    # Unless it is the first step, check that the structure is the same.
+    if self._structure is None:
+      self._update_structure(tree.map_structure(lambda _: None, data))
+
+    # The number of leaves is compared first as `tree.assert_same_structure` is
+    # expensive when it fails (the error message includes both structures).
+    flat_data = tree.flatten(data)
+    if len(flat_data) == len(self._column_history):
+      try:
+        tree.assert_same_structure(data, self._structure, True)
+        return self._flatten(flat_data), None
+      except ValueError:
+        pass
+
+    # `data` is a subset of the full spec and/or contains fields which haven't
+    # been observed before. In the latter case we need expand the spec using the
+    # union of the history and `data`.
+    flat_data_with_paths = tree.flatten_with_path(data)
+    if any(path not in self._path_to_column_index
+           for path, _ in flat_data_with_paths):
+      self._update_structure(_tree_union(self._structure, data))
+
+    # The columns of fields missing from `data` are filled in with None.
+    flat_column_data = [None] * len(self._path_to_column_index)
+    for path, leaf in flat_data_with_paths:
+      if path not in self._path_to_column_index:
+        raise ValueError(
+            f'Cannot expand {data} into {self._structure} as it is not a sub '
+            f'structure.')
+      flat_column_data[self._path_to_column_index[path]] = leaf
+
+    return flat_column_data, [path for path, _ in flat_data_with_paths]
+
+  def _structure_references(self, data, data_paths, flat_data_references):
+    """Unpacks the references of a step into the structure of `data`."""
+    # If `data` has the same structure as the history then the references can
+    # be unpacked directly into its structure.
+    if data_paths is None:
+      return self._unflatten(flat_data_references, data)
+
+    # Return the referenced structured in the same way as `data`. If only a
+    # subset of the fields were present in the input data then only these fields
+    # will exist in the output.
+    return tree.unflatten_as(data, [
+        flat_data_references[self._path_to_column_index[path]]
+        for path in data_paths
+    ])
+
+  def _flatten(self, flat_data):
+    # `flat_data` must be flattened from data with the same structure as
+    # `_structure` so the leaves can be reordered using the cached permutation
+    # instead of looking up the column of every path.
+    if self._reorder_is_identity:
+      return flat_data
+    return [flat_data[i] for i in self._column_index_to_flat_structure_index]
+
+  def _unflatten(self, flat_data, structure: Any = None):
+    # `structure` can be set to unflatten into data with the same structure as
+    # `_structure` (but possibly other container types).
+    if self._reorder_is_identity:
+      reordered_flat_data = flat_data
+    else:
+      reordered_flat_data = [
+          flat_data[i] for i in self._flat_structure_index_to_column_index
+      ]
+    return tree.unflatten_as(
+        self._structure if structure is None else structure,
+        reordered_flat_data)
 
   def _update_structure(self, new_structure: Any):
     """Replace the existing structure with a superset of the current one.
@@ -387,9 +505,12 @@ class TrajectoryWriter:
         previous structure.
     """
     # Evolve the mapping from structure path to column index.
-    for path, _ in tree.flatten_with_path(new_structure):
+    paths = [path for path, _ in tree.flatten_with_path(new_structure)]
+    new_paths = []
+    for path in paths:
       if path not in self._path_to_column_index:
         self._path_to_column_index[path] = len(self._path_to_column_index)
+        new_paths.append(path)
 
         # If an explicit config have been provided for the column then forward
         # it to the C++ writer so it will be applied when the column chunker is
@@ -398,48 +519,116 @@ class TrajectoryWriter:
           self._writer.ConfigureChunker(self._path_to_column_index[path],
                                         *self._path_to_column_config[path])
 
-    # Recalculate the reverse mapping, i.e column index to index within the
-    # flatten structure.
-    self._column_index_to_flat_structure_index = {
-        self._path_to_column_index[path]: i
-        for i, (path, _) in enumerate(tree.flatten_with_path(new_structure))
-    }
+    # Recalculate the permutations between the column order and the order of
+    # the flattened structure.
+    self._flat_structure_index_to_column_index = [
+        self._path_to_column_index[path] for path in paths
+    ]
+    self._column_index_to_flat_structure_index = [0] * len(
+        self._flat_structure_index_to_column_index)
+    for i, column_index in enumerate(
+        self._flat_structure_index_to_column_index):
+      self._column_index_to_flat_structure_index[column_index] = i
+    self._reorder_is_identity = all(
+        i == column_index for i, column_index in enumerate(
+            self._flat_structure_index_to_column_index))
 
     # New columns are always added to the back so all we need to do expand the
     # history structure is to append one column for every field added by this
     # `_update_structure` call.  In order to align indexing across all columns
     # we init the new fields with None for all steps up until this.
     history_length = len(self._column_history[0]) if self._column_history else 0
-    while len(self._column_history) < len(tree.flatten(new_structure)):
-      self._column_history.append(_ColumnHistory(history_length))
+    for path in new_paths:
+      if path in self._path_to_column_config:
+        num_keep_alive_refs = self._path_to_column_config[path][1]
+      else:
+        num_keep_alive_refs = self._num_keep_alive_refs
+      column = _ColumnHistory(num_keep_alive_refs, history_length)
+      self._column_history.append(column)
+      self._column_appenders.append(column.append)
 
     # With the mapping and history updated the structure can be set.
     self._structure = new_structure
+    self._history = self._unflatten(self._column_history)
 
 
 class _ColumnHistory:
-  """Utility class for making construction of `TrajectoryColumn`s easy."""
+  """Utility class for making construction of `TrajectoryColumn`s easy.
+
+  The C++ writer only keeps the `num_keep_alive_refs` most recent references
+  of each column alive so older references can never be used in new items.
+  Once they have expired, references (and the steps before them) are dropped
+  from the history. Steps without data (None) are not stored at all so the
+  memory usage doesn't grow with the episode length. Steps are still indexed
+  from the start of the history (i.e how many steps have been appended since
+  the last reset) so indexing stays aligned across columns.
+  """
+
+  __slots__ = ('_num_keep_alive_refs', '_data_references', '_num_steps',
+               '_num_dropped')
+
+  def __init__(self, num_keep_alive_refs: int, history_padding: int = 0):
+    self._num_keep_alive_refs = num_keep_alive_refs
+
+    # Maps step index to the reference of the steps where the column received
+    # data (i.e not None), ordered by step.
+    self._data_references: Dict[int, pybind.WeakCellRef] = (
+        collections.OrderedDict())
 
-  def __init__(self, history_padding: int = 0):
-    self._data_references = [None] * history_padding
+    # Total number of steps, including the `history_padding` steps which were
+    # appended before the column was created.
+    self._num_steps = history_padding
+
+    # Number of steps which have been dropped from the front of the history.
+    self._num_dropped = 0
 
   def append(self, ref: Optional[pybind.WeakCellRef]):
-    self._data_references.append(ref)
+    if ref is not None:
+      self._data_references[self._num_steps] = ref
+      if len(self._data_references) > self._num_keep_alive_refs:
+        self._drop_expired()
+    self._num_steps += 1
+
+  def set_num_keep_alive_refs(self, num_keep_alive_refs: int):
+    self._num_keep_alive_refs = num_keep_alive_refs
+    self._drop_expired()
 
   def reset(self):
     self._data_references.clear()
+    self._num_steps = 0
+    self._num_dropped = 0
+
+  def _drop_expired(self):
+    while len(self._data_references) > self._num_keep_alive_refs:
+      index, _ = self._data_references.popitem(last=False)
+      self._num_dropped = index + 1
 
   def __len__(self) -> int:
-    return len(self._data_references)
+    return self._num_steps
 
-  def __iter__(self) -> Iterator[pybind.WeakCellRef]:
-    return iter(self._data_references)
+  def __iter__(self) -> Iterator[Optional[pybind.WeakCellRef]]:
+    """Iterates over the references of all steps, None if dropped or missing."""
+    for index in range(self._num_steps):
+      yield self._data_references.get(index)
 
   def __getitem__(self, val) -> 'TrajectoryColumn':
     if isinstance(val, int):
-      return TrajectoryColumn([self._data_references[val]], squeeze=True)
+      index = val + self._num_steps if val < 0 else val
+      if not 0 <= index < self._num_steps:
+        raise IndexError(f'_ColumnHistory index {val} out of range')
+      if index < self._num_dropped:
+        raise IndexError(
+            f'The data reference at index {val} has expired as it is older '
+            f'than the {self._num_keep_alive_refs} most recent references.')
+      return TrajectoryColumn([self._data_references.get(index)], squeeze=True)
     elif isinstance(val, slice):
-      return TrajectoryColumn(self._data_references[val])
+      indices = range(*val.indices(self._num_steps))
+      if indices and min(indices[0], indices[-1]) < self._num_dropped:
+        raise IndexError(
+            f'The slice {val} contains data references which have expired as '
+            f'they are older than the {self._num_keep_alive_refs} most recent '
+            f'references.')
+      return TrajectoryColumn([self._data_references.get(i) for i in indices])
     else:
       raise TypeError(
           f'_ColumnHistory indices must be integers, not {type(val)}')
@@ -448,6 +637,8 @@ class _ColumnHistory:
 class TrajectoryColumn:
   """Column used for building trajectories referenced by table items."""
 
+  __slots__ = ('_data_references', 'is_squeezed')
+
   def __init__(self,
                data_references: Sequence[pybind.WeakCellRef],
                squeeze: bool = False):
@@ -476,8 +667,8 @@ class TrajectoryColumn:
     """Gets and stacks all the referenced data.
 
     Data is copied from buffers in the C++ layers and may involve decompression
-    of already created chunks. This can be quite a memory intensive operation
-    when used on large arrays.
+    of already created chunks (each chunk is only decompressed once). This can
+    be quite a memory intensive operation when used on large arrays.
 
     Returns:
       All referenced data stacked in a single numpy array if column isn't
@@ -485,17 +676,19 @@ class TrajectoryColumn:
       stacking.
 
     Raises:
+      ValueError: If any data reference is missing (None).
       RuntimeError: If any data reference has expired.
     """
-    if any(reference.expired for reference in self._data_references):
-      raise RuntimeError(
-          'Cannot convert TrajectoryColumn with expired data references to '
-          'numpy array.')
-
+    # Note that the references are checked by the C++ layer (in the same call
+    # which fetches the data) so they can't expire after being checked.
     if self.is_squeezed:
+      if self._data_references[0] is None:
+        raise ValueError(
+            'Cannot convert TrajectoryColumn with missing (None) data '
+            'reference to numpy array.')
       return self._data_references[0].numpy()
 
-    return np.stack([ref.numpy() for ref in self._data_references])
+    return pybind.stack_weak_cell_refs(self._data_references)
 
 
 def sample_trajectory(client: client_lib.Client, table: str,
@@ -526,36 +719,6 @@ def sample_trajectory(client: client_lib.Client, table: str,
       data=tree.unflatten_as(structure, sample[4:]))
 
 
-def _tree_merge_into(source, target):
-  """Update `target` with content of substructure `source`."""
-  path_to_index = {
-      path: i for i, (path, _) in enumerate(tree.flatten_with_path(target))
-  }
-
-  flat_target = tree.flatten(target)
-  for path, leaf in tree.flatten_with_path(source):
-    if path not in path_to_index:
-      raise ValueError(
-          f'Cannot expand {source} into {target} as it is not a sub structure.')
-    flat_target[path_to_index[path]] = leaf
-
-  return tree.unflatten_as(target, flat_target)
-
-
-def _tree_filter(source, filter_):
-  """Extract `filter_` from `source`."""
-  path_to_index = {
-      path: i for i, (path, _) in enumerate(tree.flatten_with_path(filter_))
-  }
-
-  flat_target = [None] * len(path_to_index)
-  for path, leaf in tree.flatten_with_path(source):
-    if path in path_to_index:
-      flat_target[path_to_index[path]] = leaf
-
-  return tree.unflatten_as(filter_, flat_target)
-
-
 def _is_named_tuple(x):
   # Classes that look syntactically as if they inherit from `NamedTuple` in
   # fact end up not doing so, so use this heuristic to detect them.
@@ -563,7 +726,18 @@ def _is_named_tuple(x):
 
 
 def _tree_union(a, b):
-  """Compute the disjunction of two trees with None leaves."""
+  """Compute the disjunction of a tree with None leaves and another tree.
+
+  Only the fields of `b` missing from `a` are mapped to None leaves so `b` does
+  not have to be converted into a tree of None leaves first.
+
+  Args:
+    a: Tree with None leaves.
+    b: Tree whose fields are added to `a`.
+
+  Returns:
+    Tree with None leaves containing the fields of both `a` and `b`.
+  """
   if a is None:
     return a
 
@@ -578,6 +752,6 @@ def _tree_union(a, b):
     if k in a:
       merged[k] = _tree_union(a[k], v)
     else:
-      merged[k] = v
+      merged[k] = tree.map_structure(lambda _: None, v)
 
   return type(a)(**merged)
@@ -41,11 +41,14 @@ class TrajectoryWriterTest(absltest.TestCase):
     self.cpp_writer_mock = mock.Mock()
     self.cpp_writer_mock.Append.side_effect = \
         lambda x: [FakeWeakCellRef(y) if y else None for y in x]
+    self.cpp_writer_mock.AppendBatch.side_effect = \
+        lambda xs, out: out.extend(self.cpp_writer_mock.Append(x) for x in xs)
 
-    client_mock = mock.Mock()
-    client_mock._client.NewTrajectoryWriter.return_value = self.cpp_writer_mock
+    self.client_mock = mock.Mock()
+    self.client_mock._client.NewTrajectoryWriter.return_value = \
+        self.cpp_writer_mock
 
-    self.writer = trajectory_writer.TrajectoryWriter(client_mock, 1, 1)
+    self.writer = trajectory_writer.TrajectoryWriter(self.client_mock, 1, 10)
 
   def test_history_require_append_to_be_called_before(self):
     with self.assertRaises(RuntimeError):
@@ -59,6 +62,18 @@ class TrajectoryWriterTest(absltest.TestCase):
     history = tree.map_structure(extract_data, self.writer.history)
     self.assertDictEqual(history, {'x': [1, 2, 3], 'y': [100, 101, 102]})
 
+  def test_history_is_updated_in_place(self):
+    self.writer.append({'x': 1})
+    history = self.writer.history
+
+    self.writer.append({'x': 2})
+    self.assertIs(self.writer.history['x'], history['x'])
+    self.assertEqual(extract_data(history['x']), [1, 2])
+
+  def test_history_is_cached(self):
+    self.writer.append({'x': 1})
+    self.assertIs(self.writer.history, self.writer.history)
+
   def test_history_structure_evolves_with_data(self):
     self.writer.append({'x': 1, 'z': 2})
     first = tree.map_structure(extract_data, self.writer.history)
@@ -80,6 +95,84 @@ class TrajectoryWriterTest(absltest.TestCase):
         'y': [None, 4, 5],
     })
 
+  def test_history_structure_evolves_with_nested_data(self):
+    self.writer.append({'x': 1})
+    self.writer.append({'x': 2, 'y': {'a': 3, 'b': [4, 5]}})
+    history = tree.map_structure(extract_data, self.writer.history)
+    self.assertDictEqual(history, {
+        'x': [1, 2],
+        'y': {
+            'a': [None, 3],
+            'b': [[None, 4], [None, 5]]
+        },
+    })
+
+  def test_history_and_references_match_data_when_columns_reordered(self):
+    # New fields are added as new columns, so after these steps the order of
+    # the columns is (c, a, b) while the flattened structure is (a, b, c).
+    self.writer.append({'c': 1})
+    self.writer.append({'a': 2, 'c': 3})
+    refs = self.writer.append({'a': 4, 'b': 5, 'c': 6})
+
+    self.assertDictEqual(
+        tree.map_structure(lambda ref: ref.data, refs),
+        {'a': 4, 'b': 5, 'c': 6})
+
+    history = tree.map_structure(extract_data, self.writer.history)
+    self.assertDictEqual(history, {
+        'a': [None, 2, 4],
+        'b': [None, None, 5],
+        'c': [1, 3, 6],
+    })
+
+  def test_history_drops_expired_references(self):
+    writer = trajectory_writer.TrajectoryWriter(self.client_mock, 1, 2)
+    for i in range(1, 6):
+      writer.append({'x': i})
+
+    # Indexing is still relative to the first step.
+    self.assertLen(writer.history['x'], 5)
+    self.assertEqual(extract_data(writer.history['x'][3:4]), [4])
+    self.assertEqual(extract_data(writer.history['x'][-2:]), [4, 5])
+
+    # But only the `num_keep_alive_refs` most recent references are kept.
+    with self.assertRaises(IndexError):
+      _ = writer.history['x'][2]
+    with self.assertRaises(IndexError):
+      _ = writer.history['x'][:]
+
+    # Negative indices are also relative to the first step.
+    with self.assertRaises(IndexError):
+      _ = writer.history['x'][-7]
+
+  def test_history_does_not_store_missing_data(self):
+    writer = trajectory_writer.TrajectoryWriter(self.client_mock, 1, 2)
+    for i in range(5):
+      writer.append({'x': i})
+    writer.append({'x': 5, 'y': 5})
+    for i in range(6, 10):
+      writer.append({'x': i})
+
+    # The steps without data are still part of the history.
+    history = writer.history['y']
+    self.assertLen(history, 10)
+    self.assertLen(list(history), 10)
+    self.assertEqual(extract_data(history[:]), [None] * 5 + [5] + [None] * 4)
+
+    # But only the references are stored.
+    self.assertLen(history._data_references, 1)
+
+  def test_history_only_counts_references_when_dropping(self):
+    writer = trajectory_writer.TrajectoryWriter(self.client_mock, 1, 2)
+    writer.append({'x': 1, 'y': 1})
+    writer.append({'y': 2})
+    writer.append({'y': 3})
+    writer.append({'x': 4, 'y': 4})
+
+    # The first `x` is still alive as the column has only received two values.
+    self.assertEqual(extract_data(writer.history['x'][:]), [1, None, None, 4])
+    self.assertEqual(extract_data(writer.history['y'][-2:]), [3, 4])
+
   def test_append_returns_same_structure_as_data(self):
     first_step_data = {'x': 1, 'y': 2}
     first_step_ref = self.writer.append(first_step_data)
@@ -91,11 +184,51 @@ class TrajectoryWriterTest(absltest.TestCase):
     second_step_ref = self.writer.append(second_step_data)
     tree.assert_same_structure(second_step_data, second_step_ref)
 
+  def test_append_raises_if_data_not_compatible_with_history(self):
+    self.writer.append({'x': 1})
+    with self.assertRaises(ValueError):
+      self.writer.append({'x': {'y': 2}})
+
   def test_append_forwards_flat_data_to_cpp_writer(self):
     data = {'x': 1, 'y': 2}
     self.writer.append(data)
     self.cpp_writer_mock.Append.assert_called_with(tree.flatten(data))
 
+  def test_append_batch_forwards_flat_data_to_cpp_writer(self):
+    data = [{'x': 1, 'y': 2}, {'x': 3, 'y': 4}]
+    self.writer.append_batch(data)
+    self.cpp_writer_mock.AppendBatch.assert_called_once_with(
+        [tree.flatten(step) for step in data], mock.ANY)
+
+  def test_append_batch_is_equivalent_to_append(self):
+    batch = [{'x': 1}, {'x': 2, 'z': 3}, {'y': 4}, {'x': 5, 'y': 6, 'z': 7}]
+
+    batch_refs = self.writer.append_batch(batch)
+    for step, step_refs in zip(batch, batch_refs):
+      tree.assert_same_structure(step, step_refs)
+      self.assertEqual(tree.map_structure(lambda ref: ref.data, step_refs),
+                       step)
+
+    history = tree.map_structure(extract_data, self.writer.history)
+    self.assertDictEqual(history, {
+        'x': [1, 2, None, 5],
+        'y': [None, None, 4, 6],
+        'z': [None, 3, None, 7],
+    })
+
+  def test_append_batch_keeps_steps_appended_before_error(self):
+    def _append_batch(batch, out):
+      out.append(self.cpp_writer_mock.Append(batch[0]))
+      raise ValueError('Failed to append the second step.')
+
+    self.cpp_writer_mock.AppendBatch.side_effect = _append_batch
+    with self.assertRaises(ValueError):
+      self.writer.append_batch([{'x': 1}, {'x': 2}, {'x': 3}])
+
+    # The first step was appended by the C++ writer so it must be in the
+    # history.
+    self.assertEqual(extract_data(self.writer.history['x']), [1])
+
   def test_create_item_checks_type_of_leaves(self):
     first = self.writer.append({'x': 3, 'y': 2})
     second = self.writer.append({'x': 3, 'y': 2})
@@ -173,6 +306,22 @@ class TrajectoryColumnTest(absltest.TestCase):
       writer.append({'a': i})
       self.assertEqual(writer.history['a'][-1].numpy(), i)
 
+  def test_numpy_raises_if_column_contains_missing_data(self):
+    # No data will ever be sent to the server so it doesn't matter that we use
+    # an invalid address.
+    client = client_lib.Client('localhost:1234')
+    writer = trajectory_writer.TrajectoryWriter(client, 5, 10)
+
+    writer.append({'x': 1})
+    writer.append({'x': 2, 'y': 3})
+
+    with self.assertRaises(ValueError):
+      writer.history['y'][:].numpy()
+
+  def test_numpy_squeeze_raises_if_data_is_missing(self):
+    with self.assertRaises(ValueError):
+      trajectory_writer.TrajectoryColumn([None], squeeze=True).numpy()
+
   def test_validates_squeeze(self):
     # Exactly one is valid.
     trajectory_writer.TrajectoryColumn([FakeWeakCellRef(1)], squeeze=True)